@@ -1,11 +1,16 @@
+import asyncio
+import heapq
+import html
 import math
 import os
-import re
 import sqlite3
-import unicodedata
+import threading
+import time
+from collections import deque
 from contextlib import closing
 from datetime import datetime, timedelta, timezone
-from typing import Iterable, List, Optional, Tuple
+from functools import lru_cache
+from typing import Callable, Iterable, List, Optional, Tuple
 
 from telegram import (
     InlineKeyboardButton,
@@ -26,6 +31,8 @@ from telegram.ext import (
     filters,
 )
 
+from search_text import normalize_text as _normalize_text, search_haystack as _search_haystack
+
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 MINIAPP_URL = os.getenv("MINIAPP_URL", "https://glutenfree-miniapp.vercel.app")
 PREMIUM_BOT_LINK = os.getenv("PREMIUM_BOT_LINK", "https://t.me/glutenfreeitaliabot?start=premium")
@@ -39,10 +46,39 @@ CONTACT_LINK = os.getenv(
 )
 DB_PATH = os.getenv("DB_PATH", "restaurants.db")
 SQLITE_TIMEOUT_SECONDS = float(os.getenv("SQLITE_TIMEOUT_SECONDS", "30"))
+SQLITE_CACHED_STATEMENTS = 256
+PREMIUM_CACHE_TTL_SECONDS = float(os.getenv("PREMIUM_CACHE_TTL_SECONDS", "60"))
+PREMIUM_CACHE_MAX_USERS = 4096
+BOT_RESULTS_LIMIT = 10
+CITY_QUERY_CACHE_TTL_SECONDS = float(os.getenv("CITY_QUERY_CACHE_TTL_SECONDS", "60"))
+CITY_QUERY_CACHE_MAX_ENTRIES = 256
+USAGE_FLUSH_INTERVAL_SECONDS = float(os.getenv("USAGE_FLUSH_INTERVAL_SECONDS", "2"))
+USAGE_FLUSH_MAX_EVENTS = 200
+USAGE_BUFFER_MAX_EVENTS = 10000
+DB_OPTIMIZE_INTERVAL_SECONDS = float(os.getenv("DB_OPTIMIZE_INTERVAL_SECONDS", str(4 * 3600)))
 
 
-def get_conn() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH, timeout=SQLITE_TIMEOUT_SECONDS)
+class _SharedConnection(sqlite3.Connection):
+    """Connessione riusata tra le chiamate: close() annulla solo la transazione aperta."""
+
+    def close(self) -> None:
+        if self.in_transaction:
+            self.rollback()
+
+    def really_close(self) -> None:
+        super().close()
+
+
+_conn_local = threading.local()
+
+
+def _open_conn() -> _SharedConnection:
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=SQLITE_TIMEOUT_SECONDS,
+        factory=_SharedConnection,
+        cached_statements=SQLITE_CACHED_STATEMENTS,
+    )
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA foreign_keys = ON")
     conn.execute("PRAGMA busy_timeout = 5000")
@@ -50,9 +86,40 @@ def get_conn() -> sqlite3.Connection:
         conn.execute("PRAGMA journal_mode = WAL")
     except sqlite3.DatabaseError:
         pass
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA mmap_size = 268435456")
+    conn.execute("PRAGMA cache_size = -65536")
     return conn
 
 
+def get_conn() -> sqlite3.Connection:
+    conn = getattr(_conn_local, "conn", None)
+    if conn is None or getattr(_conn_local, "path", None) != DB_PATH:
+        if conn is not None:
+            conn.really_close()
+        conn = _open_conn()
+        _conn_local.conn = conn
+        _conn_local.path = DB_PATH
+    return conn
+
+
+def optimize_db() -> None:
+    with closing(get_conn()) as conn:
+        conn.execute("PRAGMA optimize")
+
+
+def close_conn() -> None:
+    conn = getattr(_conn_local, "conn", None)
+    if conn is not None:
+        try:
+            conn.execute("PRAGMA optimize")
+        except sqlite3.Error:
+            pass
+        conn.really_close()
+        _conn_local.conn = None
+
+
 def _table_columns(cur: sqlite3.Cursor, table: str) -> dict:
     cur.execute(f"PRAGMA table_info({table})")
     return {row[1]: row for row in cur.fetchall()}
@@ -86,7 +153,8 @@ def _create_restaurants_table(cur: sqlite3.Cursor) -> None:
             google_maps_url TEXT,
             place_id TEXT,
             source_uid TEXT,
-            is_active INTEGER NOT NULL DEFAULT 1
+            is_active INTEGER NOT NULL DEFAULT 1,
+            search_norm TEXT
         )
         """
     )
@@ -99,6 +167,7 @@ def _create_restaurants_table(cur: sqlite3.Cursor) -> None:
     _safe_add_column(cur, "restaurants", "place_id TEXT")
     _safe_add_column(cur, "restaurants", "source_uid TEXT")
     _safe_add_column(cur, "restaurants", "is_active INTEGER NOT NULL DEFAULT 1")
+    _safe_add_column(cur, "restaurants", "search_norm TEXT")
 
     cur.execute(
         "CREATE UNIQUE INDEX IF NOT EXISTS idx_restaurants_source_uid ON restaurants(source_uid) WHERE source_uid IS NOT NULL"
@@ -108,6 +177,7 @@ def _create_restaurants_table(cur: sqlite3.Cursor) -> None:
     cur.execute("CREATE INDEX IF NOT EXISTS idx_restaurants_name ON restaurants(name)")
     cur.execute("CREATE INDEX IF NOT EXISTS idx_restaurants_place_id ON restaurants(place_id)")
     cur.execute("CREATE INDEX IF NOT EXISTS idx_restaurants_google_maps_url ON restaurants(google_maps_url)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_restaurants_rating_active ON restaurants(rating DESC, is_active)")
 
 
 def _create_aux_tables(cur: sqlite3.Cursor) -> None:
@@ -147,6 +217,11 @@ def _create_aux_tables(cur: sqlite3.Cursor) -> None:
         """
     )
 
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_usage_events_event_type ON usage_events(event_type)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_search_usage_daily_day_searches ON search_usage_daily(day, searches)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_premium_subscriptions_status ON premium_subscriptions(status)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_premium_subscriptions_updated_at ON premium_subscriptions(updated_at)")
+
 
 def _create_restaurant_reviews_table(cur: sqlite3.Cursor) -> None:
     cur.execute(
@@ -163,8 +238,12 @@ def _create_restaurant_reviews_table(cur: sqlite3.Cursor) -> None:
         )
         """
     )
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_restaurant_reviews_restaurant_id ON restaurant_reviews(restaurant_id)")
+    cur.execute("DROP INDEX IF EXISTS idx_restaurant_reviews_restaurant_id")
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_restaurant_reviews_restaurant_stars ON restaurant_reviews(restaurant_id, stars)"
+    )
     cur.execute("CREATE INDEX IF NOT EXISTS idx_restaurant_reviews_user_id ON restaurant_reviews(user_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_restaurant_reviews_updated_at ON restaurant_reviews(updated_at)")
 
 
 def _migrate_restaurant_reviews_if_needed(cur: sqlite3.Cursor) -> None:
@@ -178,8 +257,12 @@ def _migrate_restaurant_reviews_if_needed(cur: sqlite3.Cursor) -> None:
         cur.execute(
             "CREATE UNIQUE INDEX IF NOT EXISTS idx_restaurant_reviews_restaurant_user ON restaurant_reviews(restaurant_id, user_id)"
         )
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_restaurant_reviews_restaurant_id ON restaurant_reviews(restaurant_id)")
+        cur.execute("DROP INDEX IF EXISTS idx_restaurant_reviews_restaurant_id")
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_restaurant_reviews_restaurant_stars ON restaurant_reviews(restaurant_id, stars)"
+        )
         cur.execute("CREATE INDEX IF NOT EXISTS idx_restaurant_reviews_user_id ON restaurant_reviews(user_id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_restaurant_reviews_updated_at ON restaurant_reviews(updated_at)")
         return
 
     legacy_table = f"restaurant_reviews_legacy_{datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')}"
@@ -215,21 +298,111 @@ def _migrate_restaurant_reviews_if_needed(cur: sqlite3.Cursor) -> None:
         )
 
 
+_GEO_LAT_SQL = "CAST(REPLACE(TRIM({col}lat), ',', '.') AS REAL)"
+_GEO_LON_SQL = "CAST(REPLACE(TRIM({col}lon), ',', '.') AS REAL)"
+_GEO_VALID_SQL = (
+    "TRIM(COALESCE({col}lat, '')) <> '' AND TRIM(COALESCE({col}lon, '')) <> '' "
+    "AND " + _GEO_LAT_SQL + " BETWEEN -90 AND 90 AND " + _GEO_LON_SQL + " BETWEEN -180 AND 180"
+)
+
+
+def _geo_insert_sql(col: str, source: str) -> str:
+    lat = _GEO_LAT_SQL.format(col=col)
+    lon = _GEO_LON_SQL.format(col=col)
+    return (
+        f"INSERT OR REPLACE INTO restaurants_geo (id, min_lat, max_lat, min_lon, max_lon) "
+        f"SELECT {col}id, {lat}, {lat}, {lon}, {lon} {source} WHERE {_GEO_VALID_SQL.format(col=col)}"
+    )
+
+
+def _create_geo_index(cur: sqlite3.Cursor) -> None:
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'restaurants_geo'")
+    exists = cur.fetchone() is not None
+    try:
+        cur.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS restaurants_geo USING rtree(id, min_lat, max_lat, min_lon, max_lon)"
+        )
+        cur.execute("SELECT 1 FROM restaurants_geo LIMIT 1")
+    except sqlite3.OperationalError:
+        # SQLite senza rtree: la ricerca vicino a me ricade sull'indice di espressione su lat/lon.
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_restaurants_lat_lon ON restaurants("
+            + _GEO_LAT_SQL.format(col="")
+            + ", "
+            + _GEO_LON_SQL.format(col="")
+            + ")"
+        )
+        return
+
+    cur.execute("DROP INDEX IF EXISTS idx_restaurants_lat_lon")
+
+    cur.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_restaurants_geo_insert AFTER INSERT ON restaurants
+        BEGIN
+            {_geo_insert_sql("NEW.", "")};
+        END
+        """
+    )
+    cur.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_restaurants_geo_update AFTER UPDATE OF lat, lon ON restaurants
+        BEGIN
+            DELETE FROM restaurants_geo WHERE id = OLD.id;
+            {_geo_insert_sql("NEW.", "")};
+        END
+        """
+    )
+    cur.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_restaurants_geo_delete AFTER DELETE ON restaurants
+        BEGIN
+            DELETE FROM restaurants_geo WHERE id = OLD.id;
+        END
+        """
+    )
+
+    if not exists:
+        cur.execute(_geo_insert_sql("r.", "FROM restaurants r"))
+
+
+def _create_search_norm(cur: sqlite3.Cursor) -> None:
+    # search_norm viene scritto dall'import CSV; se il testo cambia senza aggiornarlo torna NULL
+    # e la ricerca ricade sul confronto in Python finché non viene ricalcolato qui.
+    cur.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_restaurants_search_norm_reset
+        AFTER UPDATE OF name, city, address, types ON restaurants
+        WHEN NEW.search_norm IS OLD.search_norm
+          AND (NEW.name IS NOT OLD.name OR NEW.city IS NOT OLD.city
+               OR NEW.address IS NOT OLD.address OR NEW.types IS NOT OLD.types)
+        BEGIN
+            UPDATE restaurants SET search_norm = NULL WHERE id = NEW.id;
+        END
+        """
+    )
+    cur.execute("SELECT id, city, name, address, types FROM restaurants WHERE search_norm IS NULL")
+    cur.executemany(
+        "UPDATE restaurants SET search_norm = ? WHERE id = ?",
+        [(_search_haystack(r["city"], r["name"], r["address"], r["types"]), r["id"]) for r in cur.fetchall()],
+    )
+
+
+_schema_ready_paths: set = set()
+
+
 def ensure_schema() -> None:
+    if DB_PATH in _schema_ready_paths:
+        return
     with closing(get_conn()) as conn:
         cur = conn.cursor()
         _create_restaurants_table(cur)
         _create_aux_tables(cur)
         _migrate_restaurant_reviews_if_needed(cur)
+        _create_geo_index(cur)
+        _create_search_norm(cur)
         conn.commit()
-
-
-def _normalize_text(value: Optional[str]) -> str:
-    text = unicodedata.normalize("NFKD", str(value or "")).encode("ascii", "ignore").decode("ascii")
-    text = text.lower().strip()
-    text = re.sub(r"[^a-z0-9\s]+", " ", text)
-    text = re.sub(r"\s+", " ", text)
-    return text
+    _schema_ready_paths.add(DB_PATH)
 
 
 def _to_float(value) -> Optional[float]:
@@ -256,16 +429,32 @@ def _normalize_coords(lat_raw, lon_raw) -> Tuple[Optional[float], Optional[float
     return lat, lon
 
 
+EARTH_RADIUS_KM = 6371.0
+
+
+_DEG_TO_RAD = math.pi / 180.0
+
+
 def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> Optional[float]:
     if None in (lat1, lon1, lat2, lon2):
         return None
-    r = 6371.0
-    phi1 = math.radians(lat1)
-    phi2 = math.radians(lat2)
-    dphi = math.radians(lat2 - lat1)
-    dlambda = math.radians(lon2 - lon1)
-    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
-    return 2 * r * math.asin(math.sqrt(a))
+    return _haversine_from(lat1, lon1)(lat2, lon2)
+
+
+def _haversine_from(lat1: float, lon1: float) -> Callable[[float, float], float]:
+    phi1 = lat1 * _DEG_TO_RAD
+    lambda1 = lon1 * _DEG_TO_RAD
+    cos_phi1 = math.cos(phi1)
+    diameter = 2 * EARTH_RADIUS_KM
+    sin, cos, asin, sqrt = math.sin, math.cos, math.asin, math.sqrt
+
+    def distance(lat2: float, lon2: float) -> float:
+        phi2 = lat2 * _DEG_TO_RAD
+        s_phi = sin((phi2 - phi1) * 0.5)
+        s_lambda = sin((lon2 * _DEG_TO_RAD - lambda1) * 0.5)
+        return diameter * asin(sqrt(s_phi * s_phi + cos_phi1 * cos(phi2) * s_lambda * s_lambda))
+
+    return distance
 
 
 def _today_utc() -> str:
@@ -280,14 +469,68 @@ def has_premium_access(user_id: int) -> bool:
     return is_user_premium(user_id)
 
 
+_usage_buffer: deque = deque(maxlen=USAGE_BUFFER_MAX_EVENTS)
+_usage_lock = threading.Lock()
+_usage_last_flush = time.monotonic()
+
+
 def log_usage_event(user_id: int, event_type: str, event_value: str = "") -> None:
-    with closing(get_conn()) as conn:
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO usage_events (user_id, event_type, event_value, created_at) VALUES (?, ?, ?, ?)",
-            (user_id or 0, event_type, (event_value or "")[:500], datetime.now(timezone.utc).isoformat()),
+    with _usage_lock:
+        _usage_buffer.append((user_id or 0, event_type, (event_value or "")[:500], time.time()))
+        due = (
+            len(_usage_buffer) >= USAGE_FLUSH_MAX_EVENTS
+            or time.monotonic() - _usage_last_flush >= USAGE_FLUSH_INTERVAL_SECONDS
         )
-        conn.commit()
+    if due:
+        flush_usage_events()
+
+
+def flush_usage_events() -> None:
+    global _usage_last_flush
+    with _usage_lock:
+        batch = list(_usage_buffer)
+        _usage_buffer.clear()
+        _usage_last_flush = time.monotonic()
+    if not batch:
+        return
+    rows = [
+        (user_id, event_type, event_value, datetime.fromtimestamp(ts, timezone.utc).isoformat())
+        for user_id, event_type, event_value, ts in batch
+    ]
+    try:
+        with closing(get_conn()) as conn:
+            cur = conn.cursor()
+            cur.executemany(
+                "INSERT INTO usage_events (user_id, event_type, event_value, created_at) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            conn.commit()
+    except sqlite3.Error as e:
+        # Il batch torna in coda per il prossimo flush: non deve far fallire la richiesta che l'ha innescato.
+        with _usage_lock:
+            _usage_buffer.extendleft(reversed(batch))
+        print("⚠️ Errore salvataggio usage_events:", e)
+
+
+async def _run_periodically(interval_seconds: float, func: Callable[[], None]) -> None:
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            await asyncio.to_thread(func)
+        except Exception as e:
+            print(f"⚠️ Errore job periodico {func.__name__}:", e)
+
+
+def start_db_jobs() -> List[asyncio.Task]:
+    return [
+        asyncio.create_task(_run_periodically(USAGE_FLUSH_INTERVAL_SECONDS, flush_usage_events)),
+        asyncio.create_task(_run_periodically(DB_OPTIMIZE_INTERVAL_SECONDS, optimize_db)),
+    ]
+
+
+def stop_db_jobs(tasks: List[asyncio.Task]) -> None:
+    for task in tasks:
+        task.cancel()
 
 
 def _parse_dt(value: str) -> Optional[datetime]:
@@ -302,22 +545,56 @@ def _parse_dt(value: str) -> Optional[datetime]:
         return None
 
 
-def is_user_premium(user_id: int) -> bool:
-    if not user_id:
-        return False
+_premium_cache: dict = {}
+_premium_cache_lock = threading.Lock()
+_premium_cache_generation = 0
+
+
+def _premium_expiry(user_id: int) -> Optional[datetime]:
+    with _premium_cache_lock:
+        cached = _premium_cache.get(user_id)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+        generation = _premium_cache_generation
+
     with closing(get_conn()) as conn:
         cur = conn.cursor()
         cur.execute("SELECT status, expires_at FROM premium_subscriptions WHERE user_id = ?", (user_id,))
         row = cur.fetchone()
-        if not row or row["status"] != "active":
-            return False
-        expires_at = _parse_dt(row["expires_at"])
-        return bool(expires_at and expires_at > datetime.now(timezone.utc))
+    expires_at = _parse_dt(row["expires_at"]) if row and row["status"] == "active" else None
+
+    if not expires_at or expires_at <= datetime.now(timezone.utc):
+        # Niente cache per i non premium: il pagamento può arrivare dal worker di polling, in un altro processo.
+        return expires_at
+
+    with _premium_cache_lock:
+        # Se nel frattempo un'attivazione/disattivazione ha invalidato la cache, il valore letto può essere vecchio.
+        if generation == _premium_cache_generation:
+            _premium_cache.pop(user_id, None)
+            if len(_premium_cache) >= PREMIUM_CACHE_MAX_USERS:
+                _premium_cache.pop(next(iter(_premium_cache)), None)
+            _premium_cache[user_id] = (time.monotonic() + PREMIUM_CACHE_TTL_SECONDS, expires_at)
+    return expires_at
+
+
+def _invalidate_premium_cache(user_id: int) -> None:
+    global _premium_cache_generation
+    with _premium_cache_lock:
+        _premium_cache_generation += 1
+        _premium_cache.pop(user_id, None)
+
+
+def is_user_premium(user_id: int) -> bool:
+    if not user_id:
+        return False
+    expires_at = _premium_expiry(user_id)
+    return bool(expires_at and expires_at > datetime.now(timezone.utc))
 
 
 def activate_premium(user_id: int) -> None:
     starts_at = datetime.now(timezone.utc)
     expires_at = starts_at + timedelta(days=PREMIUM_DURATION_DAYS)
+    starts_at_iso = starts_at.isoformat()
     with closing(get_conn()) as conn:
         cur = conn.cursor()
         cur.execute(
@@ -331,9 +608,10 @@ def activate_premium(user_id: int) -> None:
                 payment_source='telegram_stars',
                 updated_at=excluded.updated_at
             """,
-            (user_id, starts_at.isoformat(), expires_at.isoformat(), starts_at.isoformat()),
+            (user_id, starts_at_iso, expires_at.isoformat(), starts_at_iso),
         )
         conn.commit()
+    _invalidate_premium_cache(user_id)
 
 
 def deactivate_premium(user_id: int) -> None:
@@ -352,6 +630,7 @@ def deactivate_premium(user_id: int) -> None:
             (user_id, now, now, now, now, now),
         )
         conn.commit()
+    _invalidate_premium_cache(user_id)
 
 
 def get_restaurant_community_stats(restaurant_id: int) -> Tuple[Optional[float], int]:
@@ -367,6 +646,29 @@ def get_restaurant_community_stats(restaurant_id: int) -> Tuple[Optional[float],
         return avg_stars, total
 
 
+def get_restaurants_community_stats(restaurant_ids: List[int]) -> dict:
+    stats = {int(rid): (None, 0) for rid in restaurant_ids}
+    if not stats:
+        return stats
+    ids = list(stats)
+    placeholders = ", ".join("?" * len(ids))
+    with closing(get_conn()) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            SELECT restaurant_id, AVG(stars) AS avg_stars, COUNT(*) AS total_reviews
+            FROM restaurant_reviews
+            WHERE restaurant_id IN ({placeholders})
+            GROUP BY restaurant_id
+            """,
+            ids,
+        )
+        for row in cur.fetchall():
+            avg_stars = round(float(row["avg_stars"]), 1) if row["avg_stars"] is not None else None
+            stats[int(row["restaurant_id"])] = (avg_stars, int(row["total_reviews"] or 0))
+    return stats
+
+
 def upsert_restaurant_review(user_id: int, restaurant_id: int, stars: int, review_text: str = "") -> None:
     now = datetime.now(timezone.utc).isoformat()
     with closing(get_conn()) as conn:
@@ -395,9 +697,9 @@ def get_used_searches_today(user_id: int) -> int:
         return int(row["searches"]) if row else 0
 
 
-def increment_daily_searches(user_id: int) -> None:
+def increment_daily_searches(user_id: int) -> int:
     if not user_id:
-        return
+        return 0
     with closing(get_conn()) as conn:
         cur = conn.cursor()
         cur.execute(
@@ -405,15 +707,20 @@ def increment_daily_searches(user_id: int) -> None:
             INSERT INTO search_usage_daily (user_id, day, searches)
             VALUES (?, ?, 1)
             ON CONFLICT(user_id, day) DO UPDATE SET searches = searches + 1
+            RETURNING searches
             """,
             (user_id, _today_utc()),
         )
+        used = int(cur.fetchone()["searches"])
         conn.commit()
+        return used
 
 
 def get_quota_payload(user_id: int) -> dict:
-    premium = has_premium_access(user_id)
-    used = get_used_searches_today(user_id)
+    return build_quota_payload(user_id, has_premium_access(user_id), get_used_searches_today(user_id))
+
+
+def build_quota_payload(user_id: int, premium: bool, used: int) -> dict:
     remaining = 999999 if premium else max(0, FREE_SEARCHES_PER_DAY - used)
     return {
         "user_id": user_id,
@@ -426,9 +733,11 @@ def get_quota_payload(user_id: int) -> dict:
     }
 
 
-def serialize_restaurant(row: sqlite3.Row) -> dict:
+def serialize_restaurant(row: sqlite3.Row, community_stats: Optional[Tuple[Optional[float], int]] = None) -> dict:
     lat, lon = _normalize_coords(row["lat"], row["lon"])
-    community_rating, community_reviews_count = get_restaurant_community_stats(int(row["id"]))
+    if community_stats is None:
+        community_stats = get_restaurant_community_stats(int(row["id"]))
+    community_rating, community_reviews_count = community_stats
     keys = set(row.keys())
     return {
         "id": row["id"],
@@ -453,6 +762,27 @@ def serialize_restaurant(row: sqlite3.Row) -> dict:
     }
 
 
+RESTAURANT_COLUMNS = (
+    "id",
+    "name",
+    "city",
+    "address",
+    "notes",
+    "source",
+    "lat",
+    "lon",
+    "rating",
+    "rating_online_gf",
+    "types",
+    "phone",
+    "website",
+    "google_maps_url",
+    "place_id",
+    "is_active",
+)
+RESTAURANT_COLUMNS_SQL = ", ".join(RESTAURANT_COLUMNS)
+
+
 def _restaurant_score_for_query(row: sqlite3.Row, q_norm: str) -> int:
     city = _normalize_text(row["city"])
     name = _normalize_text(row["name"])
@@ -478,45 +808,161 @@ def _restaurant_score_for_query(row: sqlite3.Row, q_norm: str) -> int:
     return score
 
 
+_ACTIVE_RESTAURANTS_SQL = f"SELECT {RESTAURANT_COLUMNS_SQL} FROM restaurants WHERE COALESCE(is_active, 1) = 1"
+_TEXT_SEARCH_SQL = _ACTIVE_RESTAURANTS_SQL + " AND (search_norm IS NULL OR instr(search_norm, ?) > 0)"
+
+
 def _get_active_restaurant_rows() -> List[sqlite3.Row]:
     with closing(get_conn()) as conn:
         cur = conn.cursor()
-        cur.execute("SELECT * FROM restaurants WHERE COALESCE(is_active, 1) = 1")
+        cur.execute(_ACTIVE_RESTAURANTS_SQL)
+        return cur.fetchall()
+
+
+def _get_top_rated_rows(limit: int) -> List[sqlite3.Row]:
+    with closing(get_conn()) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT rating FROM restaurants
+            WHERE rating IS NOT NULL AND COALESCE(is_active, 1) = 1
+            ORDER BY rating DESC
+            LIMIT 1 OFFSET ?
+            """,
+            (max(limit, 1) - 1,),
+        )
+        cutoff = cur.fetchone()
+        if cutoff is None:
+            return _get_active_restaurant_rows()
+        cur.execute(_ACTIVE_RESTAURANTS_SQL + " AND rating >= ?", (cutoff["rating"],))
         return cur.fetchall()
 
 
 def query_restaurants_text(query: str, limit: int = 50) -> List[sqlite3.Row]:
-    rows = _get_active_restaurant_rows()
     q_norm = _normalize_text(query)
     if not q_norm:
+        rows = _get_top_rated_rows(limit)
         rows.sort(key=lambda r: (r["rating"] is None, -(r["rating"] or 0), _normalize_text(r["name"])))
         return rows[:limit]
 
+    with closing(get_conn()) as conn:
+        cur = conn.cursor()
+        cur.execute(_TEXT_SEARCH_SQL, (q_norm,))
+        rows = cur.fetchall()
     scored = []
     for row in rows:
+        if q_norm not in _search_haystack(row["city"], row["name"], row["address"], row["types"]):
+            continue
         score = _restaurant_score_for_query(row, q_norm)
         if score > 0:
             scored.append((score, row))
-    scored.sort(key=lambda item: (-item[0], -(item[1]["rating"] or 0), _normalize_text(item[1]["name"])))
-    return [row for _, row in scored[:limit]]
+    top = heapq.nsmallest(limit, scored, key=lambda item: (-item[0], -(item[1]["rating"] or 0), _normalize_text(item[1]["name"])))
+    return [row for _, row in top]
+
+
+_city_query_cache: dict = {}
+_city_query_cache_lock = threading.Lock()
+
+
+def clear_city_query_cache() -> None:
+    with _city_query_cache_lock:
+        _city_query_cache.clear()
 
 
 def query_by_city(city: str, limit: int = 12) -> List[sqlite3.Row]:
-    return query_restaurants_text(city, limit=limit)
+    key = (_normalize_text(city), limit)
+    with _city_query_cache_lock:
+        cached = _city_query_cache.get(key)
+        if cached and cached[0] > time.monotonic():
+            return list(cached[1])
+
+    rows = query_restaurants_text(city, limit=limit)
+    with _city_query_cache_lock:
+        _city_query_cache.pop(key, None)
+        if len(_city_query_cache) >= CITY_QUERY_CACHE_MAX_ENTRIES:
+            _city_query_cache.pop(next(iter(_city_query_cache)), None)
+        _city_query_cache[key] = (time.monotonic() + CITY_QUERY_CACHE_TTL_SECONDS, tuple(rows))
+    return rows
+
+
+_BBOX_MARGIN = 1.01
+
+
+def _bounding_box(lat: float, lon: float, radius_km: float) -> Tuple[float, float, float, float]:
+    # Stessa sfera della haversine; in longitudine la calotta è larga asin(sin(r/R) / cos φ).
+    angular = radius_km / EARTH_RADIUS_KM * _BBOX_MARGIN
+    dlat = math.degrees(angular)
+    cos_lat = math.cos(math.radians(lat))
+    if angular >= math.pi / 2 or cos_lat <= 0 or math.sin(angular) >= cos_lat:
+        return lat - dlat, lat + dlat, -180.0, 180.0
+    dlon = math.degrees(math.asin(math.sin(angular) / cos_lat))
+    if lon - dlon < -180 or lon + dlon > 180:
+        return lat - dlat, lat + dlat, -180.0, 180.0
+    return lat - dlat, lat + dlat, lon - dlon, lon + dlon
+
+
+_NEARBY_CANDIDATE_COLUMNS_SQL = "r.id, r.name, r.lat, r.lon, r.rating"
+_NEARBY_RTREE_SQL = f"""
+    SELECT {_NEARBY_CANDIDATE_COLUMNS_SQL}
+    FROM restaurants_geo g
+    JOIN restaurants r ON r.id = g.id
+    WHERE g.max_lat >= ? AND g.min_lat <= ?
+      AND g.max_lon >= ? AND g.min_lon <= ?
+      AND COALESCE(r.is_active, 1) = 1
+"""
+_NEARBY_BBOX_SQL = f"""
+    SELECT {_NEARBY_CANDIDATE_COLUMNS_SQL}
+    FROM restaurants r
+    WHERE {_GEO_LAT_SQL.format(col="r.")} BETWEEN ? AND ?
+      AND {_GEO_LON_SQL.format(col="r.")} BETWEEN ? AND ?
+      AND COALESCE(r.is_active, 1) = 1
+"""
+
+
+def _get_nearby_candidates(lat: float, lon: float, radius_km: float) -> List[tuple]:
+    bbox = _bounding_box(lat, lon, radius_km)
+    with closing(get_conn()) as conn:
+        cur = conn.cursor()
+        cur.row_factory = None
+        try:
+            cur.execute(_NEARBY_RTREE_SQL, bbox)
+        except sqlite3.OperationalError:
+            cur.execute(_NEARBY_BBOX_SQL, bbox)
+        return cur.fetchall()
+
+
+def _get_restaurant_rows_by_ids(ids: List[int]) -> dict:
+    if not ids:
+        return {}
+    placeholders = ", ".join("?" * len(ids))
+    with closing(get_conn()) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            f"SELECT {RESTAURANT_COLUMNS_SQL} FROM restaurants WHERE id IN ({placeholders}) AND COALESCE(is_active, 1) = 1",
+            ids,
+        )
+        return {row["id"]: row for row in cur.fetchall()}
 
 
 def query_nearby(lat_user: float, lon_user: float, radius_km: float = 20, limit: int = 30) -> List[Tuple[float, sqlite3.Row]]:
-    rows = _get_active_restaurant_rows()
-    results: List[Tuple[float, sqlite3.Row]] = []
-    for row in rows:
-        lat, lon = _normalize_coords(row["lat"], row["lon"])
-        if lat is None or lon is None:
-            continue
-        d = haversine_km(lat_user, lon_user, lat, lon)
-        if d is not None and d <= radius_km:
-            results.append((d, row))
-    results.sort(key=lambda item: (item[0], -(item[1]["rating"] or 0), _normalize_text(item[1]["name"])))
-    return results[:limit]
+    candidates = _get_nearby_candidates(lat_user, lon_user, radius_km)
+    distance_to = _haversine_from(lat_user, lon_user)
+    hits: List[Tuple[float, tuple]] = []
+    for rid, name, lat, lon, rating in candidates:
+        if type(lat) is float and type(lon) is float:
+            if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+                continue
+        else:
+            lat, lon = _normalize_coords(lat, lon)
+            if lat is None or lon is None:
+                continue
+        d = distance_to(lat, lon)
+        if d <= radius_km:
+            hits.append((d, (rid, rating, name)))
+    hits = heapq.nsmallest(limit, hits, key=lambda item: (item[0], -(item[1][1] or 0), _normalize_text(item[1][2])))
+
+    rows_by_id = _get_restaurant_rows_by_ids([candidate[0] for _, candidate in hits])
+    return [(d, rows_by_id[candidate[0]]) for d, candidate in hits if candidate[0] in rows_by_id]
 
 
 def inline_home_keyboard() -> InlineKeyboardMarkup:
@@ -538,15 +984,49 @@ def reply_home_keyboard() -> ReplyKeyboardMarkup:
     )
 
 
-def _restaurant_line(row: sqlite3.Row, distance_km: Optional[float] = None) -> str:
-    rating = f"{float(row['rating']):.1f}⭐" if row["rating"] is not None else "n.d."
-    gf = f" • 🌾 {float(row['rating_online_gf']):.1f}" if row["rating_online_gf"] is not None else ""
-    distance = f" • {distance_km:.1f} km" if distance_km is not None else ""
-    types = f" • {row['types']}" if row["types"] else ""
-    return f"• <b>{row['name']}</b>\n  📍 {row['city']}{types}\n  🌐 {rating}{gf}{distance}"
+def location_request_keyboard() -> ReplyKeyboardMarkup:
+    return ReplyKeyboardMarkup(
+        [[KeyboardButton("Invia posizione 📍", request_location=True)], ["❌ Annulla"]],
+        resize_keyboard=True,
+        one_time_keyboard=True,
+    )
+
+
+INLINE_HOME_KEYBOARD = inline_home_keyboard()
+REPLY_HOME_KEYBOARD = reply_home_keyboard()
+LOCATION_REQUEST_KEYBOARD = location_request_keyboard()
+
+
+_RESTAURANT_LINE_TEMPLATE = "• <b>{name}</b>\n  📍 {city}{types}\n  🌐 {rating}{gf}"
+
+
+@lru_cache(maxsize=4096)
+def _restaurant_line_body(name: str, city: str, types: Optional[str], rating, rating_gf) -> str:
+    return _RESTAURANT_LINE_TEMPLATE.format_map(
+        {
+            "name": html.escape(name),
+            "city": html.escape(city),
+            "types": f" • {html.escape(types)}" if types else "",
+            "rating": f"{float(rating):.1f}⭐" if rating is not None else "n.d.",
+            "gf": f" • 🌾 {float(rating_gf):.1f}" if rating_gf is not None else "",
+        }
+    )
 
 
-async def _send_search_results(update: Update, title: str, rows: Iterable[sqlite3.Row], distances: Optional[dict] = None):
+def _restaurant_line(row: sqlite3.Row, distance_km: Optional[float] = None) -> str:
+    body = _restaurant_line_body(row["name"], row["city"], row["types"], row["rating"], row["rating_online_gf"])
+    if distance_km is None:
+        return body
+    return f"{body} • {distance_km:.1f} km"
+
+
+async def _send_search_results(
+    update: Update,
+    title: str,
+    rows: Iterable[sqlite3.Row],
+    distances: Optional[dict] = None,
+    restore_menu: bool = False,
+):
     if not update.message:
         return
 
@@ -555,23 +1035,24 @@ async def _send_search_results(update: Update, title: str, rows: Iterable[sqlite
         await update.message.reply_text(
             "Non ho trovato risultati. Prova con un nome città più semplice, ad esempio <b>Milano</b>, <b>Roma</b> o <b>Bologna</b>.",
             parse_mode="HTML",
-            reply_markup=reply_home_keyboard(),
+            reply_markup=REPLY_HOME_KEYBOARD,
         )
         return
 
     lines = [title, ""]
-    for row in rows[:10]:
+    for row in rows[:BOT_RESULTS_LIMIT]:
         dist = distances.get(row["id"]) if distances else None
         lines.append(_restaurant_line(row, dist))
         lines.append("")
 
     lines.append("Apri la Mini App per una ricerca più avanzata e i dettagli premium.")
-    await update.message.reply_text("\n".join(lines), parse_mode="HTML", reply_markup=inline_home_keyboard())
-    await update.message.reply_text("Menu 👇", reply_markup=reply_home_keyboard())
+    await update.message.reply_text("\n".join(lines), parse_mode="HTML", reply_markup=INLINE_HOME_KEYBOARD)
+    if restore_menu:
+        await update.message.reply_text("Menu 👇", reply_markup=REPLY_HOME_KEYBOARD)
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    ensure_schema()
+    await asyncio.to_thread(ensure_schema)
     user = update.effective_user
 
     if context.args and context.args[0] == "premium":
@@ -579,13 +1060,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     text = (
-        f"Ciao {user.first_name or ''} 👋\n\n"
+        f"Ciao {html.escape(user.first_name or '')} 👋\n\n"
         "Benvenuto in <b>Glutenfree bot</b>.\n"
         "Puoi cercare una città direttamente nel bot oppure aprire la Mini App."
     )
     if update.message:
-        await update.message.reply_text(text, parse_mode="HTML", reply_markup=reply_home_keyboard())
-        await update.message.reply_text("Scegli da qui 👇", reply_markup=inline_home_keyboard())
+        await update.message.reply_text(text, parse_mode="HTML", reply_markup=REPLY_HOME_KEYBOARD)
+        await update.message.reply_text("Scegli da qui 👇", reply_markup=INLINE_HOME_KEYBOARD)
 
 
 async def premium_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -596,7 +1077,7 @@ async def myid_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if not update.message or not user:
         return
-    premium_state = "attivo" if has_premium_access(user.id) else "non attivo"
+    premium_state = "attivo" if await asyncio.to_thread(has_premium_access, user.id) else "non attivo"
     admin_state = "sì" if is_admin_user(user.id) else "no"
     await update.message.reply_text(
         (
@@ -605,30 +1086,46 @@ async def myid_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"Admin: <b>{admin_state}</b>"
         ),
         parse_mode="HTML",
-        reply_markup=reply_home_keyboard(),
+        reply_markup=REPLY_HOME_KEYBOARD,
     )
 
 
+PREMIUM_INVOICE_DESCRIPTION = f"Abbonamento mensile • ricerche illimitate per {PREMIUM_DURATION_DAYS} giorni"
+PREMIUM_INVOICE_PRICES = (LabeledPrice("Premium mensile", PREMIUM_PRICE_STARS),)
+
+
 async def send_premium_invoice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_invoice(
         chat_id=update.effective_chat.id,
         title="Glutenfree bot Premium",
-        description=f"Abbonamento mensile • ricerche illimitate per {PREMIUM_DURATION_DAYS} giorni",
+        description=PREMIUM_INVOICE_DESCRIPTION,
         payload="premium_monthly",
         currency="XTR",
-        prices=[LabeledPrice("Premium mensile", PREMIUM_PRICE_STARS)],
+        prices=PREMIUM_INVOICE_PRICES,
         provider_token="",
         start_parameter="premium",
     )
 
 
+async def _premium_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    if arg == "open":
+        await send_premium_invoice(update, context)
+
+
+CALLBACK_HANDLERS = {
+    "premium": _premium_callback,
+}
+
+
 async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     if not query:
         return
     await query.answer()
-    if query.data == "premium:open":
-        await send_premium_invoice(update, context)
+    prefix, _, arg = (query.data or "").partition(":")
+    handler = CALLBACK_HANDLERS.get(prefix)
+    if handler:
+        await handler(update, context, arg)
 
 
 async def precheckout_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -639,11 +1136,11 @@ async def successful_payment_callback(update: Update, context: ContextTypes.DEFA
     user = update.effective_user
     if not update.message or not user:
         return
-    activate_premium(user.id)
-    log_usage_event(user.id, "premium_payment_success", "telegram_stars")
+    await asyncio.to_thread(activate_premium, user.id)
+    await asyncio.to_thread(log_usage_event, user.id, "premium_payment_success", "telegram_stars")
     await update.message.reply_text(
         f"✅ Premium attivato per {PREMIUM_DURATION_DAYS} giorni.\nApri la Mini App per usare ricerche illimitate e dettagli completi.",
-        reply_markup=reply_home_keyboard(),
+        reply_markup=REPLY_HOME_KEYBOARD,
     )
 
 
@@ -652,16 +1149,24 @@ async def handle_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     lat = update.message.location.latitude
     lon = update.message.location.longitude
-    log_usage_event(update.effective_user.id, "bot_search_nearby", f"{lat},{lon}")
-    nearby = query_nearby(lat, lon, radius_km=20)
+    nearby, _ = await asyncio.gather(
+        asyncio.to_thread(query_nearby, lat, lon, radius_km=20, limit=BOT_RESULTS_LIMIT),
+        asyncio.to_thread(log_usage_event, update.effective_user.id, "bot_search_nearby", f"{lat},{lon}"),
+    )
     if not nearby:
         await update.message.reply_text(
             "Non ho trovato ristoranti con coordinate vicini alla tua posizione.",
-            reply_markup=reply_home_keyboard(),
+            reply_markup=REPLY_HOME_KEYBOARD,
         )
         return
     distances = {row["id"]: dist for dist, row in nearby}
-    await _send_search_results(update, "📍 <b>Ristoranti vicino a te</b>", [row for dist, row in nearby], distances=distances)
+    await _send_search_results(
+        update,
+        "📍 <b>Ristoranti vicino a te</b>",
+        [row for dist, row in nearby],
+        distances=distances,
+        restore_menu=True,
+    )
 
 
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -676,23 +1181,21 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(
             "Scrivi una città o anche solo parte del nome. Esempi: <b>Milano</b>, <b>Reggio</b>, <b>Bari</b>.",
             parse_mode="HTML",
-            reply_markup=reply_home_keyboard(),
+            reply_markup=REPLY_HOME_KEYBOARD,
         )
         return
 
     if text == "📍 Vicino a me":
-        log_usage_event(update.effective_user.id, "ui_click", "near_me_bot")
-        kb = ReplyKeyboardMarkup(
-            [[KeyboardButton("Invia posizione 📍", request_location=True)], ["❌ Annulla"]],
-            resize_keyboard=True,
-            one_time_keyboard=True,
+        context.user_data.pop("awaiting_city", None)
+        await asyncio.to_thread(log_usage_event, update.effective_user.id, "ui_click", "near_me_bot")
+        await update.message.reply_text(
+            "Mandami la tua posizione per cercare i locali più vicini.", reply_markup=LOCATION_REQUEST_KEYBOARD
         )
-        await update.message.reply_text("Mandami la tua posizione per cercare i locali più vicini.", reply_markup=kb)
         return
 
     if text == "❌ Annulla":
         context.user_data.clear()
-        await update.message.reply_text("Operazione annullata.", reply_markup=reply_home_keyboard())
+        await update.message.reply_text("Operazione annullata.", reply_markup=REPLY_HOME_KEYBOARD)
         return
 
     if text == "💎 Premium":
@@ -700,21 +1203,43 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if text == "🌍 Mini App":
-        await update.message.reply_text("Apri la Mini App da qui 👇", reply_markup=inline_home_keyboard())
+        await update.message.reply_text("Apri la Mini App da qui 👇", reply_markup=INLINE_HOME_KEYBOARD)
         return
 
-    if context.user_data.get("awaiting_city") or len(text) >= 2:
-        context.user_data["awaiting_city"] = False
-        rows = query_by_city(text)
-        log_usage_event(update.effective_user.id, "bot_search_city", text)
-        await _send_search_results(update, f"🔎 <b>Risultati per:</b> {text}", rows)
+    awaiting_city = context.user_data.pop("awaiting_city", False)
+    if awaiting_city or len(text) >= 2:
+        rows, _ = await asyncio.gather(
+            asyncio.to_thread(query_by_city, text, limit=BOT_RESULTS_LIMIT),
+            asyncio.to_thread(log_usage_event, update.effective_user.id, "bot_search_city", text),
+        )
+        # Dopo "🔍 Cerca per città" la tastiera home è già visibile; altrimenti può esserci quella della posizione.
+        await _send_search_results(
+            update, f"🔎 <b>Risultati per:</b> {html.escape(text)}", rows, restore_menu=not awaiting_city
+        )
+
+
+async def _post_init(application: Application):
+    application.bot_data["db_jobs"] = start_db_jobs()
+
+
+async def _post_shutdown(application: Application):
+    stop_db_jobs(application.bot_data.pop("db_jobs", []))
+    await asyncio.to_thread(flush_usage_events)
+    close_conn()
 
 
 def build_application() -> Application:
     ensure_schema()
     if not BOT_TOKEN:
         raise RuntimeError("BOT_TOKEN mancante")
-    app = Application.builder().token(BOT_TOKEN).build()
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(True)
+        .post_init(_post_init)
+        .post_shutdown(_post_shutdown)
+        .build()
+    )
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("premium", premium_command))
     app.add_handler(CommandHandler(["myid", "id"], myid_command))
@@ -728,4 +1253,8 @@ def build_application() -> Application:
 
 if __name__ == "__main__":
     application = build_application()
-    application.run_polling(drop_pending_updates=True)
+    application.run_polling(
+        timeout=30,
+        allowed_updates=[Update.MESSAGE, Update.CALLBACK_QUERY, Update.PRE_CHECKOUT_QUERY],
+        drop_pending_updates=True,
+    )
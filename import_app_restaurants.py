@@ -6,6 +6,8 @@ from contextlib import closing
 from datetime import datetime, timezone
 from typing import Optional
 
+from search_text import search_haystack
+
 DB_PATH = os.getenv("DB_PATH", "restaurants.db")
 CSV_PATH = os.getenv("CSV_PATH", "app_restaurants.csv")
 SQLITE_TIMEOUT_SECONDS = float(os.getenv("SQLITE_TIMEOUT_SECONDS", "30"))
@@ -56,7 +58,8 @@ def _ensure_restaurants_schema(cur: sqlite3.Cursor) -> None:
             google_maps_url TEXT,
             place_id TEXT,
             source_uid TEXT,
-            is_active INTEGER NOT NULL DEFAULT 1
+            is_active INTEGER NOT NULL DEFAULT 1,
+            search_norm TEXT
         )
         """
     )
@@ -68,6 +71,7 @@ def _ensure_restaurants_schema(cur: sqlite3.Cursor) -> None:
     _safe_add_column(cur, "restaurants", "place_id TEXT")
     _safe_add_column(cur, "restaurants", "source_uid TEXT")
     _safe_add_column(cur, "restaurants", "is_active INTEGER NOT NULL DEFAULT 1")
+    _safe_add_column(cur, "restaurants", "search_norm TEXT")
 
     cur.execute(
         "CREATE UNIQUE INDEX IF NOT EXISTS idx_restaurants_source_uid ON restaurants(source_uid) WHERE source_uid IS NOT NULL"
@@ -76,6 +80,27 @@ def _ensure_restaurants_schema(cur: sqlite3.Cursor) -> None:
     cur.execute("CREATE INDEX IF NOT EXISTS idx_restaurants_is_active ON restaurants(is_active)")
     cur.execute("CREATE INDEX IF NOT EXISTS idx_restaurants_place_id ON restaurants(place_id)")
     cur.execute("CREATE INDEX IF NOT EXISTS idx_restaurants_google_maps_url ON restaurants(google_maps_url)")
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_restaurants_source_name_city_nocase "
+        "ON restaurants(source, name COLLATE NOCASE, city COLLATE NOCASE)"
+    )
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS csv_imports (
+            csv_path TEXT PRIMARY KEY,
+            csv_sha1 TEXT NOT NULL,
+            imported_at TEXT NOT NULL
+        )
+        """
+    )
+
+
+def _file_sha1(path: str) -> str:
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 
 def _to_float(v):
@@ -166,9 +191,9 @@ def _find_existing_restaurant(cur: sqlite3.Cursor, row: dict, source_uid: str) -
         SELECT id, COALESCE(is_active, 1) AS is_active
         FROM restaurants
         WHERE source = ?
-          AND lower(name) = lower(?)
-          AND lower(city) = lower(?)
-          AND lower(COALESCE(address, '')) = lower(?)
+          AND name = ? COLLATE NOCASE
+          AND city = ? COLLATE NOCASE
+          AND COALESCE(address, '') = ? COLLATE NOCASE
         LIMIT 1
         """,
         (CSV_SOURCE, name, city, address),
@@ -176,17 +201,24 @@ def _find_existing_restaurant(cur: sqlite3.Cursor, row: dict, source_uid: str) -
     return cur.fetchone()
 
 
-def import_app_restaurants():
+def import_app_restaurants(force: bool = False):
     if not os.path.exists(CSV_PATH):
         raise FileNotFoundError(f"CSV non trovato: {CSV_PATH}")
 
     now = datetime.now(timezone.utc).isoformat()
+    csv_sha1 = _file_sha1(CSV_PATH)
 
     with closing(get_conn()) as conn:
         cur = conn.cursor()
         _ensure_restaurants_schema(cur)
         conn.commit()
 
+        cur.execute("SELECT csv_sha1 FROM csv_imports WHERE csv_path = ?", (os.path.abspath(CSV_PATH),))
+        last_import = cur.fetchone()
+        if not force and last_import and last_import["csv_sha1"] == csv_sha1:
+            print(f"⏭️ CSV invariato, import saltato: {CSV_PATH}")
+            return
+
         print(f"📂 Leggo il file CSV: {CSV_PATH}")
         inserted = 0
         updated = 0
@@ -196,6 +228,7 @@ def import_app_restaurants():
 
         cur.execute("DROP TABLE IF EXISTS tmp_imported_source_uids")
         cur.execute("CREATE TEMP TABLE tmp_imported_source_uids (source_uid TEXT PRIMARY KEY)")
+        imported_source_uids = set()
 
         with open(CSV_PATH, "r", encoding="utf-8-sig", newline="") as f:
             reader = csv.DictReader(f)
@@ -230,7 +263,7 @@ def import_app_restaurants():
                 lat_db = str(lat) if lat is not None else None
                 lon_db = str(lon) if lon is not None else None
 
-                cur.execute("INSERT OR IGNORE INTO tmp_imported_source_uids(source_uid) VALUES (?)", (source_uid,))
+                imported_source_uids.add(source_uid)
                 existing = _find_existing_restaurant(cur, row, source_uid)
 
                 payload = (
@@ -250,6 +283,7 @@ def import_app_restaurants():
                     google_maps_url,
                     place_id,
                     source_uid,
+                    search_haystack(city, name, address, types),
                 )
 
                 if existing:
@@ -272,6 +306,7 @@ def import_app_restaurants():
                             google_maps_url = ?,
                             place_id = ?,
                             source_uid = ?,
+                            search_norm = ?,
                             is_active = 1
                         WHERE id = ?
                         """,
@@ -300,14 +335,19 @@ def import_app_restaurants():
                             google_maps_url,
                             place_id,
                             source_uid,
+                            search_norm,
                             is_active
                         )
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1)
                         """,
                         payload,
                     )
                     inserted += 1
 
+        cur.executemany(
+            "INSERT INTO tmp_imported_source_uids(source_uid) VALUES (?)",
+            ((source_uid,) for source_uid in imported_source_uids),
+        )
         cur.execute(
             """
             UPDATE restaurants
@@ -323,11 +363,19 @@ def import_app_restaurants():
         )
         deactivated = cur.rowcount
 
+        cur.execute(
+            """
+            INSERT INTO csv_imports (csv_path, csv_sha1, imported_at) VALUES (?, ?, ?)
+            ON CONFLICT(csv_path) DO UPDATE SET csv_sha1 = excluded.csv_sha1, imported_at = excluded.imported_at
+            """,
+            (os.path.abspath(CSV_PATH), csv_sha1, now),
+        )
         conn.commit()
+        cur.execute("PRAGMA optimize")
         print(f"✅ Import completato. Inseriti: {inserted} • Aggiornati: {updated} • Riattivati: {reactivated}")
         print(f"🧹 Righe disattivate perché assenti nel CSV: {deactivated}")
         print(f"📍 Coordinate valide trovate: {coords_ok} • Righe saltate: {skipped}")
 
 
 if __name__ == "__main__":
-    import_app_restaurants()
+    import_app_restaurants(force=True)
@@ -0,0 +1,22 @@
+import re
+import unicodedata
+from functools import lru_cache
+from typing import Optional
+
+_NON_ALNUM_RE = re.compile(r"[^a-z0-9\s]+")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=32768)
+def normalize_text(value: Optional[str]) -> str:
+    text = unicodedata.normalize("NFKD", str(value or "")).encode("ascii", "ignore").decode("ascii")
+    text = text.lower().strip()
+    text = _NON_ALNUM_RE.sub(" ", text)
+    text = _WHITESPACE_RE.sub(" ", text)
+    return text
+
+
+@lru_cache(maxsize=8192)
+def search_haystack(city: Optional[str], name: Optional[str], address: Optional[str], types: Optional[str]) -> str:
+    """Testo normalizzato su cui gira la ricerca: salvato anche in restaurants.search_norm."""
+    return "\n".join(normalize_text(value) for value in (city, name, address, types))
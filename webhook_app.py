@@ -1,5 +1,7 @@
+import asyncio
 import hashlib
 import hmac
+import html
 import json
 import os
 from contextlib import asynccontextmanager, closing
@@ -17,12 +19,18 @@ from bot_glutenfree import (
     CONTACT_LINK,
     MINIAPP_URL,
     PREMIUM_BOT_LINK,
+    RESTAURANT_COLUMNS_SQL,
     activate_premium,
     build_application,
+    build_quota_payload,
+    clear_city_query_cache,
+    close_conn,
     deactivate_premium,
     ensure_schema,
+    flush_usage_events,
     get_conn,
     get_quota_payload,
+    get_restaurants_community_stats,
     has_premium_access,
     increment_daily_searches,
     is_admin_user,
@@ -30,6 +38,8 @@ from bot_glutenfree import (
     query_nearby,
     query_restaurants_text,
     serialize_restaurant,
+    start_db_jobs,
+    stop_db_jobs,
     upsert_restaurant_review,
 )
 from import_app_restaurants import import_app_restaurants
@@ -127,17 +137,16 @@ def require_telegram_user(init_data: str = "") -> Tuple[int, dict]:
     return uid, parsed
 
 
-def maybe_increment_quota(user_id: int) -> dict:
-    qp = get_quota_payload(user_id)
-    if qp["paywall_required"]:
+def maybe_increment_quota(user_id: int, qp: Optional[dict] = None) -> dict:
+    if qp is None:
+        qp = get_quota_payload(user_id)
+    if qp["paywall_required"] or qp["is_premium"]:
         return qp
-    if not qp["is_premium"]:
-        increment_daily_searches(user_id)
-    return get_quota_payload(user_id)
+    return build_quota_payload(user_id, False, increment_daily_searches(user_id))
 
 
-def serialize_restaurant_public(row):
-    item = serialize_restaurant(row)
+def serialize_restaurant_public(row, community_stats=None):
+    item = serialize_restaurant(row, community_stats)
     return {
         "id": item["id"],
         "name": item["name"],
@@ -154,37 +163,47 @@ def serialize_restaurant_public(row):
     }
 
 
+def serialize_restaurants_public(rows) -> list:
+    stats = get_restaurants_community_stats([int(r["id"]) for r in rows])
+    return [serialize_restaurant_public(r, stats[int(r["id"])]) for r in rows]
+
+
+_RESTAURANT_BY_ID_SQL = f"SELECT {RESTAURANT_COLUMNS_SQL} FROM restaurants WHERE id = ? AND COALESCE(is_active, 1) = 1"
+
+
 def get_restaurant_by_id(restaurant_id: int):
     with closing(get_conn()) as conn:
         cur = conn.cursor()
-        cur.execute("SELECT * FROM restaurants WHERE id = ? AND COALESCE(is_active, 1) = 1", (restaurant_id,))
+        cur.execute(_RESTAURANT_BY_ID_SQL, (restaurant_id,))
         return cur.fetchone()
 
 
 def build_admin_dashboard() -> dict:
+    flush_usage_events()
     with closing(get_conn()) as conn:
         cur = conn.cursor()
-        cur.execute("SELECT COUNT(*) AS c FROM restaurants WHERE COALESCE(is_active, 1) = 1")
-        restaurants_total = cur.fetchone()["c"]
-
-        cur.execute("SELECT COUNT(*) AS c FROM premium_subscriptions WHERE status = 'active'")
-        premium_active = cur.fetchone()["c"]
-
-        cur.execute("SELECT COUNT(*) AS c FROM premium_subscriptions")
-        subscriptions_total = cur.fetchone()["c"]
-
-        cur.execute("SELECT COUNT(DISTINCT user_id) AS c FROM search_usage_daily")
-        unique_search_users = cur.fetchone()["c"]
-
         today = datetime.now(timezone.utc).date().isoformat()
-        cur.execute("SELECT COALESCE(SUM(searches), 0) AS c FROM search_usage_daily WHERE day = ?", (today,))
-        searches_today = cur.fetchone()["c"]
-
-        cur.execute("SELECT COALESCE(SUM(searches), 0) AS c FROM search_usage_daily")
-        searches_total = cur.fetchone()["c"]
-
-        cur.execute("SELECT COUNT(*) AS c FROM restaurant_reviews")
-        reviews_total = cur.fetchone()["c"]
+        cur.execute(
+            """
+            SELECT
+                (SELECT COUNT(*) FROM restaurants WHERE COALESCE(is_active, 1) = 1) AS restaurants_total,
+                (SELECT COUNT(*) FROM premium_subscriptions WHERE status = 'active') AS premium_active,
+                (SELECT COUNT(*) FROM premium_subscriptions) AS subscriptions_total,
+                (SELECT COUNT(DISTINCT user_id) FROM search_usage_daily) AS unique_search_users,
+                (SELECT COALESCE(SUM(searches), 0) FROM search_usage_daily WHERE day = ?) AS searches_today,
+                (SELECT COALESCE(SUM(searches), 0) FROM search_usage_daily) AS searches_total,
+                (SELECT COUNT(*) FROM restaurant_reviews) AS reviews_total
+            """,
+            (today,),
+        )
+        totals = cur.fetchone()
+        restaurants_total = totals["restaurants_total"]
+        premium_active = totals["premium_active"]
+        subscriptions_total = totals["subscriptions_total"]
+        unique_search_users = totals["unique_search_users"]
+        searches_today = totals["searches_today"]
+        searches_total = totals["searches_total"]
+        reviews_total = totals["reviews_total"]
 
         cur.execute(
             "SELECT user_id, status, starts_at, expires_at, payment_source, updated_at FROM premium_subscriptions ORDER BY updated_at DESC LIMIT 100"
@@ -229,22 +248,33 @@ def build_admin_dashboard() -> dict:
     }
 
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    global telegram_app
-    ensure_schema()
+def _run_csv_import() -> None:
     try:
         import_app_restaurants()
         print("✅ CSV import completato")
     except Exception as e:
         print("⚠️ Errore import CSV:", e)
+    finally:
+        clear_city_query_cache()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global telegram_app
+    ensure_schema()
+    import_task = asyncio.create_task(asyncio.to_thread(_run_csv_import))
+    db_jobs = start_db_jobs()
 
     telegram_app = build_application()
     await telegram_app.initialize()
     await telegram_app.start()
     yield
+    await import_task
     await telegram_app.stop()
     await telegram_app.shutdown()
+    stop_db_jobs(db_jobs)
+    flush_usage_events()
+    close_conn()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -276,11 +306,12 @@ async def api_public_config():
 
 
 @app.get("/api/me")
-async def api_me(init_data: str = Query(default=""), user_id: int = Query(default=0)):
+def api_me(init_data: str = Query(default=""), user_id: int = Query(default=0)):
     del user_id
     parsed = validate_telegram_init_data(init_data)
     uid = _parsed_user_id(parsed)
     user = parsed.get("user") if isinstance(parsed, dict) else None
+    quota = get_quota_payload(uid)
     return {
         "ok": True,
         "authenticated": bool(uid),
@@ -288,21 +319,21 @@ async def api_me(init_data: str = Query(default=""), user_id: int = Query(defaul
         "username": (user or {}).get("username", ""),
         "first_name": (user or {}).get("first_name", ""),
         "is_admin": is_admin_user(uid),
-        "is_premium": has_premium_access(uid),
-        "quota": get_quota_payload(uid),
+        "is_premium": quota["is_premium"],
+        "quota": quota,
         "contact_link": CONTACT_LINK,
         "admin_telegram_id_configured": bool(ADMIN_TELEGRAM_ID),
     }
 
 
 @app.get("/api/quota")
-async def api_quota(init_data: str = Query(default=""), user_id: int = Query(default=0)):
+def api_quota(init_data: str = Query(default=""), user_id: int = Query(default=0)):
     uid = resolve_user_id(init_data, user_id)
     return get_quota_payload(uid)
 
 
 @app.get("/api/admin/dashboard")
-async def api_admin_dashboard(init_data: str = Query(default=""), user_id: int = Query(default=0)):
+def api_admin_dashboard(init_data: str = Query(default=""), user_id: int = Query(default=0)):
     del user_id
     uid, _ = require_telegram_user(init_data)
     if not is_admin_user(uid):
@@ -311,7 +342,7 @@ async def api_admin_dashboard(init_data: str = Query(default=""), user_id: int =
 
 
 @app.post("/api/admin/test-premium")
-async def api_admin_test_premium(init_data: str = Query(default=""), user_id: int = Query(default=0)):
+def api_admin_test_premium(init_data: str = Query(default=""), user_id: int = Query(default=0)):
     del user_id
     uid, _ = require_telegram_user(init_data)
     if not is_admin_user(uid):
@@ -322,7 +353,7 @@ async def api_admin_test_premium(init_data: str = Query(default=""), user_id: in
 
 
 @app.post("/api/admin/remove-premium")
-async def api_admin_remove_premium(init_data: str = Query(default=""), user_id: int = Query(default=0)):
+def api_admin_remove_premium(init_data: str = Query(default=""), user_id: int = Query(default=0)):
     del user_id
     uid, _ = require_telegram_user(init_data)
     if not is_admin_user(uid):
@@ -333,7 +364,7 @@ async def api_admin_remove_premium(init_data: str = Query(default=""), user_id:
 
 
 @app.get("/api/restaurants/{restaurant_id}/details")
-async def api_restaurant_details(restaurant_id: int, init_data: str = Query(default=""), user_id: int = Query(default=0)):
+def api_restaurant_details(restaurant_id: int, init_data: str = Query(default=""), user_id: int = Query(default=0)):
     del user_id
     uid, _ = require_telegram_user(init_data)
     if not has_premium_access(uid):
@@ -350,11 +381,11 @@ async def api_restaurant_details(restaurant_id: int, init_data: str = Query(defa
 async def api_restaurant_booked(restaurant_id: int, init_data: str = Query(default=""), user_id: int = Query(default=0)):
     del user_id
     uid, _ = require_telegram_user(init_data)
-    row = get_restaurant_by_id(restaurant_id)
+    row = await asyncio.to_thread(get_restaurant_by_id, restaurant_id)
     if not row:
         raise HTTPException(status_code=404, detail="Restaurant not found")
 
-    log_usage_event(uid, "restaurant_booked", str(restaurant_id))
+    await asyncio.to_thread(log_usage_event, uid, "restaurant_booked", str(restaurant_id))
     sent = False
     if telegram_app is not None:
         try:
@@ -362,7 +393,7 @@ async def api_restaurant_booked(restaurant_id: int, init_data: str = Query(defau
             await telegram_app.bot.send_message(
                 chat_id=uid,
                 text=(
-                    f"📅 Hai prenotato da <b>{row['name']}</b>.\n\n"
+                    f"📅 Hai prenotato da <b>{html.escape(row['name'])}</b>.\n\n"
                     f"Quando vuoi, torna su <b>Glutenfree bot</b> e lascia una recensione per aiutare la community."
                 ),
                 parse_mode="HTML",
@@ -375,7 +406,7 @@ async def api_restaurant_booked(restaurant_id: int, init_data: str = Query(defau
 
 
 @app.post("/api/restaurants/{restaurant_id}/review")
-async def api_restaurant_review(
+def api_restaurant_review(
     restaurant_id: int,
     payload: ReviewIn,
     init_data: str = Query(default=""),
@@ -390,19 +421,18 @@ async def api_restaurant_review(
         raise HTTPException(status_code=404, detail="Restaurant not found")
     upsert_restaurant_review(uid, restaurant_id, payload.stars, payload.review_text)
     log_usage_event(uid, "restaurant_review_submit", f"{restaurant_id}:{payload.stars}")
-    refreshed = get_restaurant_by_id(restaurant_id) or row
-    item = serialize_restaurant(refreshed)
+    item = serialize_restaurant(row)
     return {"ok": True, "item": item}
 
 
 @app.get("/api/restaurants")
-async def api_restaurants(q: str = Query(default=""), limit: int = Query(default=50, ge=1, le=200)):
+def api_restaurants(q: str = Query(default=""), limit: int = Query(default=50, ge=1, le=200)):
     rows = query_restaurants_text(q, limit=limit)
-    return [serialize_restaurant_public(r) for r in rows]
+    return serialize_restaurants_public(rows)
 
 
 @app.get("/api/restaurants/search")
-async def api_restaurants_search(
+def api_restaurants_search(
     q: str = Query(default=""),
     limit: int = Query(default=50, ge=1, le=200),
     init_data: str = Query(default=""),
@@ -413,14 +443,14 @@ async def api_restaurants_search(
     if qp["paywall_required"]:
         return {"ok": False, "paywall": True, "quota": qp, "items": []}
 
-    qp = maybe_increment_quota(uid)
+    qp = maybe_increment_quota(uid, qp)
     rows = query_restaurants_text(q, limit=limit)
     log_usage_event(uid, "api_search_text", q or "")
-    return {"ok": True, "paywall": False, "quota": qp, "items": [serialize_restaurant_public(r) for r in rows]}
+    return {"ok": True, "paywall": False, "quota": qp, "items": serialize_restaurants_public(rows)}
 
 
 @app.get("/api/restaurants/nearby")
-async def api_restaurants_nearby(
+def api_restaurants_nearby(
     lat: float = Query(...),
     lon: float = Query(...),
     radius_km: float = Query(default=20, ge=1, le=100),
@@ -433,12 +463,13 @@ async def api_restaurants_nearby(
     if qp["paywall_required"]:
         return {"ok": False, "paywall": True, "quota": qp, "items": []}
 
-    qp = maybe_increment_quota(uid)
+    qp = maybe_increment_quota(uid, qp)
     rows = query_nearby(lat, lon, radius_km=radius_km, limit=limit)
     log_usage_event(uid, "api_search_nearby", f"{lat},{lon}")
+    stats = get_restaurants_community_stats([int(row["id"]) for _, row in rows])
     items = []
     for distance_km, row in rows:
-        item = serialize_restaurant(row)
+        item = serialize_restaurant(row, stats[int(row["id"])])
         item["distance_km"] = round(distance_km, 2)
         items.append(item)
     return {"ok": True, "paywall": False, "quota": qp, "items": items}